@@ -2,6 +2,8 @@
 #
 # When you just want to update twitter status and nothing else, ez_tweet is there.
 
+import threading
+import time
 from twython import Twython, TwythonError, TwythonAuthError, TwythonStreamError, TwythonRateLimitError
 
 
@@ -9,21 +11,42 @@ class EZTweet(object):
 
     """docstring for EZTweet"""
 
-    def __init__(self, appkey, appsecret, oauthtoken, oauthtokensecret):
+    def __init__(self, appkey, appsecret, oauthtoken, oauthtokensecret, twitter=None):
         super(EZTweet, self).__init__()
-        self.twitter = Twython(appkey, appsecret, oauthtoken, oauthtokensecret)
+        if twitter is None:
+            twitter = Twython(appkey, appsecret, oauthtoken, oauthtokensecret)
+        self.twitter = twitter
         self.lastTweet = ""
 
     def __what_to_do__(self, e):
         """
         Internal function for figuring out what to do with a Twython exception
+        >>> ez = EZTweet(None, None, None, None, twitter=object())
+        >>> ez.__what_to_do__(TwythonRateLimitError("slow down", 429, retry_after=int(time.time()) + 90)) in (89, 90)
+        True
+        >>> ez.__what_to_do__(TwythonRateLimitError("slow down", 429, retry_after="30"))
+        30
+        >>> ez.__what_to_do__(TwythonError("bad gateway", error_code=502))
+        60
+        >>> ez.__what_to_do__(TwythonAuthError("nope", error_code=401))
+        Traceback (most recent call last):
+        ...
+        TwythonAuthError: Twitter API returned a 401 (Unauthorized), nope
         """
-        if e is TwythonAuthError:
+        if isinstance(e, TwythonAuthError):
             raise e
-        elif e is TwythonStreamError:
+        elif isinstance(e, TwythonStreamError):
             raise e
-        elif e is TwythonRateLimitError:
-            return e.retry_after
+        elif isinstance(e, TwythonRateLimitError):
+            # twython hands back the X-Rate-Limit-Reset header, which is an
+            # epoch time, not a number of seconds.
+            try:
+                retryAfter = int(e.retry_after)
+            except (TypeError, ValueError):
+                return 15 * 60
+            if retryAfter > 1000000000:
+                retryAfter -= int(time.time())
+            return max(retryAfter, 1)
         elif e.error_code in [502, 503, 504]:
             return 1 * 60
         elif e.error_code in [403]:
@@ -44,11 +67,165 @@ class EZTweet(object):
             return 60
         try:
             self.twitter.update_status(status=status)
+            self.lastTweet = status
         except TwythonError as e:
             retVal = self.__what_to_do__(e)
-        self.lastTweet = status
         return retVal
 
+
+class EZTweetOutbox(object):
+
+    """
+    Non-blocking front end for EZTweet.  post() never waits on the network; a
+    background thread sends the most recently posted status when twitter will
+    take it.  Only one status is ever queued, so a newer status replaces an
+    older one still waiting to go out, and repeats of what was last sent are
+    dropped.  Failures back off exponentially (capped at maxBackoff), or as
+    long as twitter's rate limit asks, whichever is longer.
+
+    >>> class StubTwitter(object):
+    ...     def __init__(self):
+    ...         self.statuses = []
+    ...         self.errors = []
+    ...     def update_status(self, status):
+    ...         if self.errors:
+    ...             raise self.errors.pop(0)
+    ...         self.statuses.append(status)
+    >>> stub = StubTwitter()
+    >>> outbox = EZTweetOutbox(EZTweet(None, None, None, None, twitter=stub), start=False)
+    >>> outbox.post("55.0F, calm")
+    >>> outbox.post("56.0F, calm")
+    >>> outbox.sendPending(now=0)
+    -1
+    >>> stub.statuses, outbox.superseded
+    (['56.0F, calm'], 1)
+    >>> outbox.post("56.0F, calm")
+    >>> outbox.pending is None, outbox.suppressed
+    (True, 1)
+    >>> stub.errors = [TwythonError("bad gateway", error_code=502)] * 2
+    >>> outbox.post("57.0F, calm")
+    >>> [outbox.sendPending(now=0), outbox.sendPending(now=59), outbox.sendPending(now=60)]
+    Tweet failed.  Next attempt in 60 seconds
+    Tweet failed.  Next attempt in 120 seconds
+    [60, 1, 120]
+    >>> outbox.sendPending(now=180), stub.statuses
+    (-1, ['56.0F, calm', '57.0F, calm'])
+    >>> outbox.post("58.0F, calm")
+    >>> outbox.post("57.0F, calm")
+    >>> outbox.pending is None, outbox.superseded
+    (True, 2)
+    >>> stub.errors = [TwythonError("Connection aborted."), TwythonAuthError("nope", error_code=401)]
+    >>> outbox.post("59.0F, calm")
+    >>> outbox.sendPending(now=200), outbox.pending
+    Tweet failed: Connection aborted.
+    Tweet failed.  Next attempt in 60 seconds
+    (60, '59.0F, calm')
+    >>> outbox.sendPending(now=260), outbox.pending
+    Tweet dropped: Twitter API returned a 401 (Unauthorized), nope
+    (None, None)
+    """
+
+    def __init__(self, ezTweet, minBackoff=60, maxBackoff=60 * 60, start=True):
+        super(EZTweetOutbox, self).__init__()
+        self.ezTweet = ezTweet
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.pending = None
+        self.notBefore = 0
+        self.failures = 0
+        self.sent = 0
+        self.superseded = 0
+        self.suppressed = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__run__)
+        self.thread.daemon = True
+        if start:
+            self.thread.start()
+
+    def post(self, status):
+        """
+        Queue status for sending and return immediately.
+        """
+        with self.condition:
+            if status == self.pending:
+                return
+            if self.pending is not None:
+                self.superseded += 1
+                self.pending = None
+            if status == self.ezTweet.lastTweet:
+                # twitter already shows the current conditions
+                self.suppressed += 1
+                return
+            self.pending = status
+            self.condition.notify()
+
+    def __backoff__(self, now, retryTime=0):
+        """
+        Push the next attempt out exponentially, or by retryTime if longer.
+        """
+        with self.condition:
+            delay = max(retryTime, min(self.maxBackoff, self.minBackoff * 2 ** self.failures))
+            self.failures += 1
+            self.notBefore = now + delay
+        return delay
+
+    def sendPending(self, now=None):
+        """
+        Try to send the pending status if it is due.  Returns -1 once it has
+        gone out, otherwise the number of seconds until the next attempt
+        (None when there is nothing to send).
+        """
+        if now is None:
+            now = time.time()
+        with self.condition:
+            status = self.pending
+            if status is None:
+                return None
+            if now < self.notBefore:
+                return self.notBefore - now
+        try:
+            retryTime = self.ezTweet.tweet(status)
+        except (TwythonAuthError, TwythonStreamError) as e:
+            # retrying won't help this status; still back off before the next
+            print "Tweet dropped: {0}".format(e)
+            with self.condition:
+                if self.pending == status:
+                    self.pending = None
+            self.__backoff__(now)
+            return None
+        except TwythonError as e:
+            # connection trouble or an error code we don't know: try again
+            print "Tweet failed: {0}".format(e)
+            retryTime = 0
+        if retryTime == -1:
+            with self.condition:
+                if self.pending == status:
+                    self.pending = None
+                self.failures = 0
+                self.notBefore = 0
+                self.sent += 1
+            return -1
+        delay = self.__backoff__(now, retryTime)
+        print "Tweet failed.  Next attempt in %i seconds" % delay
+        return delay
+
+    def __run__(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+            try:
+                delay = self.sendPending()
+            except Exception as e:
+                print "Unexpected exception caught while tweeting!"
+                print e
+                delay = self.__backoff__(time.time())
+            if delay is not None and delay > 0:
+                with self.condition:
+                    # post() wakes us early, but sendPending() keeps the backoff
+                    self.condition.wait(delay)
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
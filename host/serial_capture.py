@@ -1,23 +1,272 @@
-# wx_bridge.py - by baldnate
-# Simple test script for troubleshooting issues with ear.ino
+# serial_capture.py - by baldnate
+# Capture tool for troubleshooting the serial link to serialmaster.ino
+#
+# Raw bytes are read off the port in bulk: a frame starts with the first byte
+# after the line goes idle (and is stamped with its arrival time) and runs
+# until the line goes quiet again, so a frame normally holds a whole packet.
+# A background thread writes the frames into capture files that rotate by
+# size and can optionally be gzipped.
+#
+# Capture file format (all integers little-endian):
+# * header: the 8 bytes "WXCAP01\n"
+# * frames: double receive time (seconds since epoch, UTC),
+#           uint32 payload length,
+#           payload bytes exactly as read from the port (NULs and all)
+#
+# A ".gz" suffix means the whole file (header included) is gzip compressed.
+# Files are named <output>.<UTC start time>[.gz] so a new run or rotation
+# never clobbers an earlier capture.
 
 import serial
 import json
+import datetime
+import gzip
+import struct
+import threading
+import time
+import Queue
 
-prefs = json.load(open('prefs.json'))
+MAGIC = "WXCAP01\n"
+FRAME_HEADER = struct.Struct("<dI")
 
-connected = False
-for serialPort in prefs["SERIAL_PORTS"]:
+
+def openCapture(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def readCapture(path):
+    """
+    Generator yielding (timestamp, payload) for each frame in a capture file.
+    A truncated final frame (e.g. capture killed mid-write) is ignored, as is
+    the missing gzip trailer of a compressed capture that was never closed.
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "test.wxcap")
+    >>> w = CaptureWriter(path)
+    >>> w.push(1.5, "{\\"name\\": \\"temp\\"}\\r\\n")
+    >>> w.push(2.25, "\\x00\\x00garbage")
+    >>> w.close()
+    >>> list(readCapture(w.paths[0]))
+    [(1.5, '{"name": "temp"}\\r\\n'), (2.25, '\\x00\\x00garbage')]
+    """
+    f = openCapture(path, "rb")
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        while True:
+            try:
+                header = f.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    return
+                (timestamp, length) = FRAME_HEADER.unpack(header)
+                payload = f.read(length)
+            except (IOError, EOFError, struct.error):
+                # gzip stream cut off without its trailer
+                return
+            if len(payload) < length:
+                return
+            yield (timestamp, payload)
+    finally:
+        f.close()
+
+
+class CaptureWriter(object):
+
+    """
+    Buffered, rotating writer for capture frames.  push() only queues; a
+    background thread does all of the file I/O.  If that thread fails (disk
+    full, permissions, ...) the error is kept in self.error and push() raises
+    IOError from then on, so a capture can't silently stop recording.
+    """
+
+    def __init__(self, path, rotateBytes=0, compress=False, flushInterval=1.0, maxQueued=10000):
+        super(CaptureWriter, self).__init__()
+        self.path = path
+        self.rotateBytes = rotateBytes
+        self.compress = compress
+        self.flushInterval = flushInterval
+        self.paths = []
+        self.frames = 0
+        self.bytes = 0
+        self.queue = Queue.Queue(maxQueued)
+        self.error = None
+        self.file = None
+        self.fileBytes = 0
+        self.thread = threading.Thread(target=self.__run__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def push(self, timestamp, payload):
+        while True:
+            if self.error is not None:
+                raise IOError("capture writer failed: {0}".format(self.error))
+            try:
+                self.queue.put((timestamp, payload), timeout=1)
+                return
+            except Queue.Full:
+                continue
+
+    def close(self):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                break
+            except Queue.Full:
+                continue
+        self.thread.join()
+
+    def __rotate__(self):
+        if self.file:
+            self.file.close()
+        path = "%s.%s" % (self.path, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S.%f"))
+        if self.compress:
+            path += ".gz"
+        self.file = openCapture(path, "wb")
+        self.file.write(MAGIC)
+        self.fileBytes = len(MAGIC)
+        self.paths.append(path)
+
+    def __write__(self, frames):
+        if self.file is None:
+            self.__rotate__()
+        for (timestamp, payload) in frames:
+            if self.rotateBytes and self.fileBytes >= self.rotateBytes:
+                self.__rotate__()
+            self.file.write(FRAME_HEADER.pack(timestamp, len(payload)))
+            self.file.write(payload)
+            self.fileBytes += FRAME_HEADER.size + len(payload)
+            self.frames += 1
+            self.bytes += len(payload)
+
+    def __run__(self):
+        try:
+            self.__drain__()
+        except Exception as e:
+            self.error = e
+            print "Capture writer failed!"
+            print e
+        finally:
+            if self.file:
+                try:
+                    self.file.close()
+                except Exception:
+                    pass
+                self.file = None
+
+    def __drain__(self):
+        lastFlush = time.time()
+        done = False
+        while not done:
+            try:
+                frames = [self.queue.get(timeout=self.flushInterval)]
+            except Queue.Empty:
+                frames = []
+            # drain whatever else has piled up so it goes out in one batch
+            while True:
+                try:
+                    frames.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in frames:
+                frames = frames[:frames.index(None)]
+                done = True
+            if frames:
+                self.__write__(frames)
+            now = time.time()
+            if self.file and (done or now - lastFlush >= self.flushInterval):
+                self.file.flush()
+                lastFlush = now
+
+
+def capture(ser, writer, idleChars=20, maxFrame=64 * 1024, count=None):
+    """
+    Bulk read from ser into writer until interrupted (or count frames).
+    Blocks in the driver while the port is idle.  Once a byte arrives, the
+    rest of the frame is collected every idleChars character times until the
+    line goes quiet, so there are a handful of wakeups per packet, not one
+    per byte.
+
+    Driving a pty at 9600 baud line rate gives one frame per packet:
+    >>> import os, tty, tempfile, threading
+    >>> (master, slave) = os.openpty()
+    >>> tty.setraw(slave)
+    >>> ser = serial.Serial(os.ttyname(slave), 9600, timeout=1)
+    >>> packets = ['{"name": "windrain", "rainticks": 3, "windticks": %i, "winddir": 90.00}\\r\\n' % i for i in range(3)]
+    >>> def station():
+    ...     for packet in packets:
+    ...         for c in packet:
+    ...             os.write(master, c)
+    ...             time.sleep(1 / 960.0)
+    ...         time.sleep(0.2)
+    >>> feeder = threading.Thread(target=station)
+    >>> feeder.start()
+    >>> w = CaptureWriter(os.path.join(tempfile.mkdtemp(), "test.wxcap"))
+    >>> capture(ser, w, count=3)
+    >>> feeder.join(); w.close()
+    >>> [payload for (timestamp, payload) in readCapture(w.paths[0])] == packets
+    True
+    """
+    idle = idleChars * 10.0 / ser.baudrate
+    frames = 0
+    while count is None or frames < count:
+        payload = ser.read(1)
+        if not payload:
+            continue
+        timestamp = time.time()
+        while len(payload) < maxFrame:
+            time.sleep(idle)
+            waiting = ser.inWaiting()
+            if not waiting:
+                break
+            payload += ser.read(waiting)
+        writer.push(timestamp, payload)
+        frames += 1
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='serial_capture')
+    parser.add_argument('-t', '--doctest', help='Run doctests', required=False, action="store_true")
+    parser.add_argument('-o', '--output', help='Capture file name prefix', default='capture.wxcap')
+    parser.add_argument('-r', '--rotate-mb', help='Start a new file after this many MB (0 disables)', type=float, default=64)
+    parser.add_argument('-z', '--gzip', help='gzip capture files', required=False, action="store_true")
+    parser.add_argument('-p', '--replay', help='Dump an existing capture file to stdout and exit', required=False)
+    args = parser.parse_args()
+
+    if args.doctest:
+        import doctest
+        doctest.testmod()
+        exit()
+
+    if args.replay:
+        for (timestamp, payload) in readCapture(args.replay):
+            print "%.6f %r" % (timestamp, payload)
+        exit()
+
+    prefs = json.load(open('prefs.json'))
+
+    connected = False
+    for serialPort in prefs["SERIAL_PORTS"]:
+        try:
+            ser = serial.Serial(serialPort, 9600, timeout=1)
+            connected = True
+            break
+        except:
+            continue
+
+    if not(connected):
+        print "Could not connect to serial port, check connections and prefs.json[SERIAL_PORTS]."
+        exit(-1)
+
+    writer = CaptureWriter(args.output, int(args.rotate_mb * 1024 * 1024), args.gzip)
+    print "serial_capture listening to {0}, writing to {1}".format(serialPort, args.output)
     try:
-        ser = serial.Serial(serialPort, 9600)
-        connected = True
-        break
-    except:
-        continue
-
-if not(connected):
-    print "Could not connect to serial port, check connections and prefs.json[SERIAL_PORTS]."
-    exit(-1)
-
-while True:
-    print ser.readline()
+        capture(ser, writer)
+    except KeyboardInterrupt:
+        pass
+    except IOError as e:
+        print e
+    finally:
+        writer.close()
+        print "Captured {0} bytes in {1} frames.".format(writer.bytes, writer.frames)
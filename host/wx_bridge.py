@@ -18,7 +18,7 @@ import simplejson as json
 import datetime
 import math
 import wx_math
-from ez_tweet import EZTweet
+from ez_tweet import EZTweet, EZTweetOutbox
 from wx_pws import WundergroundPWS
 from copy import copy
 import pytz
@@ -168,7 +168,8 @@ class WindData(object):
 
 class WeatherUndergroundData(object):
 
-    def __init__(self, pwsInterval, tweetInterval):
+    def __init__(self, pwsInterval, tweetInterval, altitudeInMeters):
+        self.altitudeInMeters = altitudeInMeters
         self.maxInterval = max(pwsInterval, tweetInterval, 120, 600)
         self.tweetInterval = tweetInterval if tweetInterval else self.maxInterval
         self.currInterval = pwsInterval if pwsInterval else self.maxInterval
@@ -256,9 +257,9 @@ class WeatherUndergroundData(object):
             self.dewpointf = wx_math.dewpoint(self.tempf, self.humidity)
             self.heatindexf = wx_math.temperatureHumidityIndex(self.tempf, self.humidity)
             self.windchillf = wx_math.windChill(self.tempf, self.windAvg2m.speed)
-            self.baromin = wx_math.pascalsToAltSettingInHg(observation["pressure"], prefs["WX_ALTITUDE_IN_METERS"])
+            self.baromin = wx_math.pascalsToAltSettingInHg(observation["pressure"], self.altitudeInMeters)
             if self.baromin is None:
-                print "Bogus pressure encountered!  pascals:{0}, alt:{1}".format(observation["pressure"], prefs["WX_ALTITUDE_IN_METERS"])
+                print "Bogus pressure encountered!  pascals:{0}, alt:{1}".format(observation["pressure"], self.altitudeInMeters)
         self.lastUpdate = observation["timestamp"]
 
     def formatApparentTemperature(self):
@@ -319,62 +320,25 @@ def getChunk(ser):
         yield line
 
 
-if __name__ == "__main__":
-    import argparse
-    parser = argparse.ArgumentParser(description='wx_bridge')
-    parser.add_argument('-t', '--doctest', help='Run doctests', required=False, action="store_true")
-    parser.add_argument('-d', '--debug', help='Run in debug mode', required=False, action="store_true")
-    args = parser.parse_args()
-
-    if args.doctest:
-        import doctest
-        doctest.testmod()
-        exit()
-
-    debugMode = args.debug
-
-    prefs = json.load(open('prefs.json'))
-
-    ser = None
-    connected = False
-    for serialPort in prefs["SERIAL_PORTS"]:
-        try:
-            ser = serial.Serial(serialPort, 9600)
-            connected = True
-            break
-        except:
-            continue
-
-    if not(connected):
-        print "Could not connect to serial port, check connections and prefs.json[SERIAL_PORTS]."
-        exit(-1)
-
-    reportKey = "REPORT_CFG"
-    if debugMode:
-        reportKey = "REPORT_CFG_DEBUG"
-
-    tweetInterval = prefs[reportKey]["tweet"]
-    consoleInterval = prefs[reportKey]["console"]
-    pwsInterval = prefs[reportKey]["pws"]
-    prefill = prefs[reportKey]["prefill"]
-    pws = prefs[reportKey]["pws"]
-    wud = WeatherUndergroundData(pwsInterval, tweetInterval)
+def bridge(lines, wud, twitter, pws, reportCfg, onObservation=None):
+    """
+    Main ingest loop: parse each packet in lines, fold it into wud and publish
+    to pws/twitter/stdout as the intervals in reportCfg come due.  twitter is
+    an EZTweetOutbox, so tweeting never holds up the loop.
+    onObservation, if given, is called with each packet once it is published,
+    or once it has been folded into wud for the first reportCfg["prefill"]
+    packets, which are never published.
+    """
+    tweetInterval = reportCfg["tweet"]
+    consoleInterval = reportCfg["console"]
+    pwsInterval = reportCfg["pws"]
+    prefill = reportCfg["prefill"]
 
     # assume the worst: that we just updated before this script ran
     lastPWSTime = lastTweetTime = lastConsoleTime = lastUpdateRateTime = datetime.datetime.utcnow()
-    tweetRetryDelay = 0
-    lastTweetText = ""
     updates = 0
-    secrets = json.load(open('secrets.json'))
-
-    twitter = EZTweet(secrets['APP_KEY'], secrets['APP_SECRET'], secrets['OAUTH_TOKEN'], secrets['OAUTH_TOKEN_SECRET'])
-    pws = WundergroundPWS(secrets['PWS_ID'], secrets['PWS_PASSWORD'], rtfreq=pwsInterval)
 
-    print "wx_bridge initialized and listening to {0}".format(serialPort)
-    if debugMode:
-        print "debugging mode ON"
-
-    for line in getChunk(ser):
+    for line in lines:
         time = datetime.datetime.utcnow()
         try:
             data = json.loads(line)
@@ -395,6 +359,8 @@ if __name__ == "__main__":
             updates = updates + 1
             if prefill:
                 prefill -= 1
+                if onObservation:
+                    onObservation(data)
                 continue
             if updates % 100 == 0:
                 print "{0:.2f} reports/sec".format(updates / (time - lastUpdateRateTime).total_seconds())
@@ -407,17 +373,62 @@ if __name__ == "__main__":
                 print "tweet: " + ", ".join([x for x in wud.tweet() if x is not None])
                 print "console: " + " ".join([(x if x is not None else "XXXXX") for x in wud.console()])
                 lastConsoleTime = time
-            if tweetInterval and ((time - lastTweetTime).total_seconds() >= (tweetInterval + tweetRetryDelay)):
-                status = ", ".join([x for x in wud.tweet() if x is not None])
-                retryTime = twitter.tweet(status)
-                if retryTime == -1:
-                    lastTweetTime = time
-                    tweetRetryDelay = 0
-                else:
-                    print "Tweet failed.  Next attempt in %i seconds" % retryTime
-                    tweetRetryDelay += retryTime
+            if tweetInterval and (time - lastTweetTime).total_seconds() >= tweetInterval:
+                # hand off to the outbox, which deals with retries and rate limits
+                twitter.post(", ".join([x for x in wud.tweet() if x is not None]))
+                lastTweetTime = time
+            if onObservation:
+                onObservation(data)
         except Exception as e:
             print "Unexpected exception caught!"
             print "Line being processed:\n{0}\n".format(line)
             print "Exception details:"
-            print e
\ No newline at end of file
+            print e
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='wx_bridge')
+    parser.add_argument('-t', '--doctest', help='Run doctests', required=False, action="store_true")
+    parser.add_argument('-d', '--debug', help='Run in debug mode', required=False, action="store_true")
+    args = parser.parse_args()
+
+    if args.doctest:
+        import doctest
+        doctest.testmod()
+        exit()
+
+    debugMode = args.debug
+
+    prefs = json.load(open('prefs.json'))
+
+    ser = None
+    connected = False
+    for serialPort in prefs["SERIAL_PORTS"]:
+        try:
+            ser = serial.Serial(serialPort, 9600)
+            connected = True
+            break
+        except:
+            continue
+
+    if not(connected):
+        print "Could not connect to serial port, check connections and prefs.json[SERIAL_PORTS]."
+        exit(-1)
+
+    reportKey = "REPORT_CFG"
+    if debugMode:
+        reportKey = "REPORT_CFG_DEBUG"
+
+    reportCfg = prefs[reportKey]
+    wud = WeatherUndergroundData(reportCfg["pws"], reportCfg["tweet"], prefs["WX_ALTITUDE_IN_METERS"])
+    secrets = json.load(open('secrets.json'))
+
+    twitter = EZTweetOutbox(EZTweet(secrets['APP_KEY'], secrets['APP_SECRET'], secrets['OAUTH_TOKEN'], secrets['OAUTH_TOKEN_SECRET']))
+    pws = WundergroundPWS(secrets['PWS_ID'], secrets['PWS_PASSWORD'], rtfreq=reportCfg["pws"])
+
+    print "wx_bridge initialized and listening to {0}".format(serialPort)
+    if debugMode:
+        print "debugging mode ON"
+
+    bridge(getChunk(ser), wud, twitter, pws, reportCfg)
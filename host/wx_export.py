@@ -0,0 +1,285 @@
+# encoding: utf-8
+
+# wx_export.py - by baldnate
+#
+# Bulk, columnar export of observation history for offline analysis.
+#
+# Observation history lives in serial_capture.py capture files.  Packets are
+# pulled out of those, grouped by packet name, and buffered as per-field
+# columns.  Every chunkRows packets a chunk gets converted with numpy (the
+# wx_math conversions, applied to whole columns at once) and written out,
+# so memory use stays bounded no matter how many months get exported.
+#
+# Output formats:
+# * npz: <outdir>/<name>-<chunk>.npz, one array per field
+# * csv: <outdir>/<name>.csv, header line then rows, appended a chunk at a time
+#
+# Each export goes into its own, empty directory.  importHistory() reads one
+# format back into {name: {field: array}}.  npz is the fast path: its chunks
+# load straight into arrays, while csv has to be parsed as text (done in
+# blocks so the parser's overhead stays bounded).
+
+import glob
+import itertools
+import os
+import simplejson as json
+import numpy as np
+import wx_math
+from serial_capture import readCapture
+
+PACKET_FIELDS = {
+    "windrain": ["rainticks", "windticks", "winddir"],
+    "temp": ["humidity", "pressure", "pTempf", "hTempf"],
+}
+
+
+# The vectorised conversions below mirror wx_math line for line.  Each one's
+# doctest checks it against the scalar wx_math version, so a fix to one side
+# that isn't made to the other shows up as a failure.
+TEST_TEMPS = np.array([-20.0, 0.0, 32.0, 50.0, 72.5, 80.0, 100.0])
+TEST_RHS = np.array([5.0, 20.0, 30.0, 50.0, 65.0, 90.0, 100.0])
+
+
+def matchesWxMath(vectorised, scalar):
+    """
+    True if the vectorised results equal the scalar ones (None meaning nan).
+    """
+    scalar = np.array([np.nan if x is None else x for x in scalar], dtype=np.float64)
+    return np.allclose(vectorised, scalar, equal_nan=True)
+
+
+def fixBogusTempReadings(bogusF):
+    """
+    Vectorised wx_math.fixBogusTempReading.
+    >>> fixBogusTempReadings(np.array([491.23, 0, 72.5])).round(2).tolist()
+    [30.43, 0.0, 72.5]
+    >>> readings = np.concatenate([TEST_TEMPS, [250.0, 250.5, 300.0, 490.1, 491.23, 492.62]])
+    >>> matchesWxMath(fixBogusTempReadings(readings), [wx_math.fixBogusTempReading(x) for x in readings])
+    True
+    """
+    bogusF = np.asarray(bogusF, dtype=np.float64)
+    return np.where(bogusF > 250, wx_math.cToF(-1 * (128 - (wx_math.fToC(bogusF) % 128))), bogusF)
+
+
+def dewpoints(degF, rh):
+    """
+    Vectorised wx_math.dewpoint.
+    >>> dewpoints(np.array([100.0]), np.array([50.0])).round().tolist()
+    [78.0]
+    >>> matchesWxMath(dewpoints(TEST_TEMPS, TEST_RHS), [wx_math.dewpoint(t, rh) for (t, rh) in zip(TEST_TEMPS, TEST_RHS)])
+    True
+    """
+    tempC = wx_math.fToC(np.asarray(degF, dtype=np.float64))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = (np.log(np.asarray(rh, dtype=np.float64) / 100.0) + ((17.27 * tempC) / (237.3 + tempC))) / 17.27
+        return wx_math.cToF((237.3 * b) / (1.0 - b))
+
+
+def temperatureHumidityIndexes(degF, rh):
+    """
+    Vectorised wx_math.temperatureHumidityIndex.
+    >>> temperatureHumidityIndexes(np.array([100.0, 80.0]), np.array([50.0, 30.0])).round().tolist()
+    [112.0, 78.0]
+    >>> matchesWxMath(temperatureHumidityIndexes(TEST_TEMPS, TEST_RHS),
+    ...               [wx_math.temperatureHumidityIndex(t, rh) for (t, rh) in zip(TEST_TEMPS, TEST_RHS)])
+    True
+    """
+    t = np.asarray(degF, dtype=np.float64)
+    d = dewpoints(t, rh)
+    return t - 0.9971 * np.exp(0.02086 * t) * (1 - np.exp(0.0445 * (d - 57.2)))
+
+
+def pascalsToAltSettingsInHg(pascals, altitudeInMeters):
+    """
+    Vectorised wx_math.pascalsToAltSettingInHg.  Bogus pressures become nan.
+    >>> (pascalsToAltSettingsInHg(np.array([102700, 0]), 100) * 100).round().tolist()
+    [3068.0, nan]
+    >>> pascals = np.array([0.0, 29.0, 31.0, 50000.0, 99577.93, 102700.0, 108000.0])
+    >>> all(matchesWxMath(pascalsToAltSettingsInHg(pascals, alt), [wx_math.pascalsToAltSettingInHg(p, alt) for p in pascals])
+    ...     for alt in [0.0, 100.0, 269.933, 1500.0])
+    True
+    """
+    a = wx_math.pascalsToMb(np.asarray(pascals, dtype=np.float64)) - 0.3
+    a = np.where(a < 0.0, np.nan, a)
+    i0 = np.power(a, 0.190284)
+    i1 = ((altitudeInMeters / i0) * 0.000084228806861) + 1
+    i2 = np.power(i1, 5.255302600323727)
+    return wx_math.mbToInchesHg(i2 * a)
+
+
+def convertChunk(name, columns, altitudeInMeters):
+    """
+    Turn buffered column lists into arrays and add derived fields.  The raw
+    pTempf/hTempf readings are kept as-is; the corrected ones are
+    pTempfFixed/hTempfFixed.
+    """
+    arrays = dict((k, np.array(v, dtype=np.float64)) for (k, v) in columns.items())
+    if name == "temp":
+        arrays["pTempfFixed"] = fixBogusTempReadings(arrays["pTempf"])
+        arrays["hTempfFixed"] = fixBogusTempReadings(arrays["hTempf"])
+        arrays["tempf"] = (arrays["pTempfFixed"] + arrays["hTempfFixed"]) / 2.0
+        arrays["dewpointf"] = dewpoints(arrays["tempf"], arrays["humidity"])
+        arrays["heatindexf"] = temperatureHumidityIndexes(arrays["tempf"], arrays["humidity"])
+        arrays["baromin"] = pascalsToAltSettingsInHg(arrays["pressure"], altitudeInMeters)
+    return arrays
+
+
+def readPackets(paths):
+    """
+    Generator yielding (timestamp, packet) for every well-formed packet in the
+    given capture files.  A line is stamped with the receive time of the read
+    that completed it.  Malformed lines are skipped, same as wx_bridge.
+    """
+    pending = ""
+    for path in paths:
+        for (timestamp, payload) in readCapture(path):
+            lines = (pending + payload.replace(chr(0), "")).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                try:
+                    packet = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(packet, dict) and packet.get("name") in PACKET_FIELDS:
+                    yield (timestamp, packet)
+
+
+class ChunkWriter(object):
+
+    """
+    Writes converted chunks for one packet name in either npz or csv format.
+    """
+
+    def __init__(self, outdir, name, format):
+        super(ChunkWriter, self).__init__()
+        self.outdir = outdir
+        self.name = name
+        self.format = format
+        self.chunks = 0
+        self.rows = 0
+        self.fields = None
+
+    def write(self, arrays):
+        if self.fields is None:
+            self.fields = ["timestamp"] + sorted(x for x in arrays if x != "timestamp")
+        if self.format == "npz":
+            path = os.path.join(self.outdir, "%s-%05i.npz" % (self.name, self.chunks))
+            np.savez(path, **arrays)
+        else:
+            path = os.path.join(self.outdir, "%s.csv" % self.name)
+            block = np.column_stack([arrays[x] for x in self.fields])
+            with open(path, "wb" if self.chunks == 0 else "ab") as f:
+                np.savetxt(f, block, fmt="%.6f", delimiter=",",
+                           header=",".join(self.fields) if self.chunks == 0 else "", comments="")
+        self.chunks += 1
+        self.rows += len(arrays["timestamp"])
+
+
+def exportHistory(paths, outdir, format="npz", chunkRows=100000, altitudeInMeters=0):
+    """
+    Export every packet in the capture files at paths to outdir, which must
+    be empty or not exist yet.  Returns {name: rows written}.
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    elif os.listdir(outdir):
+        raise ValueError("%s is not empty; export into a fresh directory" % outdir)
+    buffers = dict((name, None) for name in PACKET_FIELDS)
+    writers = dict((name, ChunkWriter(outdir, name, format)) for name in PACKET_FIELDS)
+
+    def newBuffer(name):
+        return dict((field, []) for field in ["timestamp"] + PACKET_FIELDS[name])
+
+    def flush(name):
+        if buffers[name] and buffers[name]["timestamp"]:
+            writers[name].write(convertChunk(name, buffers[name], altitudeInMeters))
+        buffers[name] = newBuffer(name)
+
+    for name in PACKET_FIELDS:
+        buffers[name] = newBuffer(name)
+    for (timestamp, packet) in readPackets(paths):
+        name = packet["name"]
+        try:
+            values = [packet[field] for field in PACKET_FIELDS[name]]
+        except KeyError:
+            # garbled packet, see TODO.md
+            continue
+        columns = buffers[name]
+        columns["timestamp"].append(timestamp)
+        for (field, value) in zip(PACKET_FIELDS[name], values):
+            columns[field].append(value)
+        if len(columns["timestamp"]) >= chunkRows:
+            flush(name)
+    for name in PACKET_FIELDS:
+        flush(name)
+    return dict((name, writers[name].rows) for name in PACKET_FIELDS)
+
+
+def readCSV(path, blockRows=100000):
+    """
+    Bulk load a csv export as {field: array}, parsing blockRows lines at a time.
+    """
+    with open(path, "rb") as f:
+        fields = f.readline().strip().split(",")
+        blocks = []
+        while True:
+            lines = list(itertools.islice(f, blockRows))
+            if not lines:
+                break
+            blocks.append(np.loadtxt(lines, delimiter=",", ndmin=2))
+    if not blocks:
+        return dict((k, np.zeros(0)) for k in fields)
+    table = np.concatenate(blocks)
+    return dict((k, table[:, i]) for (i, k) in enumerate(fields))
+
+
+def importHistory(indir, format="npz", names=None):
+    """
+    Load an export back in as {name: {field: array}}.
+    >>> import tempfile
+    >>> for format in ["npz", "csv"]:
+    ...     outdir = tempfile.mkdtemp()
+    ...     w = ChunkWriter(outdir, "windrain", format)
+    ...     for chunk in range(3):
+    ...         w.write(convertChunk("windrain", {"timestamp": [chunk], "winddir": [45.0 * chunk]}, 0))
+    ...     importHistory(outdir, format)["windrain"]["winddir"].tolist()
+    [0.0, 45.0, 90.0]
+    [0.0, 45.0, 90.0]
+    """
+    history = {}
+    if format == "npz":
+        for path in sorted(glob.glob(os.path.join(indir, "*.npz"))):
+            name = os.path.basename(path).rsplit("-", 1)[0]
+            if names and name not in names:
+                continue
+            with np.load(path) as chunk:
+                history.setdefault(name, []).append(dict((k, chunk[k]) for k in chunk.files))
+    else:
+        for path in sorted(glob.glob(os.path.join(indir, "*.csv"))):
+            name = os.path.basename(path)[:-len(".csv")]
+            if names and name not in names:
+                continue
+            history.setdefault(name, []).append(readCSV(path))
+    return dict((name, dict((k, np.concatenate([c[k] for c in chunks])) for k in chunks[0]))
+                for (name, chunks) in history.items())
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='wx_export')
+    parser.add_argument('-t', '--doctest', help='Run doctests', required=False, action="store_true")
+    parser.add_argument('-o', '--output', help='Output directory', default='export')
+    parser.add_argument('-f', '--format', help='Output format', choices=['npz', 'csv'], default='npz')
+    parser.add_argument('-c', '--chunk-rows', help='Packets per chunk', type=int, default=100000)
+    parser.add_argument('captures', help='serial_capture.py capture files', nargs='*')
+    args = parser.parse_args()
+
+    if args.doctest:
+        import doctest
+        doctest.testmod()
+        exit()
+
+    prefs = json.load(open('prefs.json'))
+    rows = exportHistory(sorted(args.captures), args.output, args.format, args.chunk_rows, prefs["WX_ALTITUDE_IN_METERS"])
+    for (name, count) in sorted(rows.items()):
+        print "{0}: {1} rows".format(name, count)
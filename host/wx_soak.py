@@ -0,0 +1,329 @@
+# wx_soak.py - by baldnate
+#
+# Soak/load harness for wx_bridge.
+#
+# A virtual serialmaster.ino is run on one end of a pseudo-terminal pair and
+# the real wx_bridge ingest loop reads from the other end, publishing to local
+# stand-ins for Twitter and Wunderground.  The virtual station can mangle its
+# output the way the real serial link does (see TODO.md): truncated packets,
+# NUL padding, corrupted bytes, and bursts of back-to-back packets.
+#
+# Every emitted packet carries an extra "sent" field with the time it was
+# written to the pty; wx_bridge ignores unknown fields, so latency is measured
+# from then until the bridge has finished publishing that packet.
+
+import errno
+import fcntl
+import os
+import sys
+import tty
+import random
+import resource
+import threading
+import time
+import serial
+import wx_bridge
+from ez_tweet import EZTweet, EZTweetOutbox
+
+# Keep reports readable; the bridge prints a lot when fed garbage.
+DEVNULL = open(os.devnull, "w")
+
+
+def maxRSSKb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on macOS, KB everywhere else
+        rss /= 1024
+    return rss
+
+
+def currentRSSKb():
+    """
+    Resident set size right now, so steady growth can be told apart from a
+    one-off spike.  Falls back to the peak where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return maxRSSKb()
+    return pages * resource.getpagesize() / 1024
+
+
+def percentile(values, p):
+    """
+    >>> percentile([5, 1, 4, 2, 3], 50)
+    3
+    >>> percentile([], 99) is None
+    True
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class VirtualStation(object):
+
+    """
+    Emulates serialmaster.ino output at a configurable packet rate, with
+    optional fault injection.  Fault rates are probabilities per packet.
+    fd must be non-blocking (see openPty).  offered counts every packet
+    generated; written counts those that made it into the pty (a packet the
+    pty only took part of is finished before anything else is written);
+    overflow counts those dropped because the reader had fallen behind.
+    """
+
+    def __init__(self, fd, rate, truncate=0.0, nulpad=0.0, corrupt=0.0, burst=0.0, burstSize=20, seed=None):
+        super(VirtualStation, self).__init__()
+        self.fd = fd
+        self.rate = rate
+        self.truncate = truncate
+        self.nulpad = nulpad
+        self.corrupt = corrupt
+        self.burst = burst
+        self.burstSize = burstSize
+        self.random = random.Random(seed)
+        self.offered = 0
+        self.written = 0
+        self.overflow = 0
+        self.tail = ""
+        self.faults = dict(truncate=0, nulpad=0, corrupt=0, burst=0)
+        self.rainticks = 0
+        self.windticks = 0
+        self.running = False
+        self.thread = threading.Thread(target=self.__run__)
+        self.thread.daemon = True
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def packet(self):
+        """
+        Next packet, alternating temp and windrain like serialmaster.ino.
+        Floats are formatted the way Serial.print(float) formats them.
+        """
+        sent = "%.6f" % time.time()
+        if self.offered % 2 == 0:
+            return '{"name": "temp", "humidity": %.2f, "pressure": %.2f, "pTempf": %.2f, "hTempf": %.2f, "sent": %s}\r\n' % (
+                self.random.uniform(20, 90), self.random.uniform(97000, 100000),
+                self.random.uniform(30, 90), self.random.uniform(30, 90), sent)
+        self.windticks = (self.windticks + self.random.randint(0, 20)) % 4294967296
+        if self.random.random() < 0.01:
+            self.rainticks = (self.rainticks + 1) % 65536
+        return '{"name": "windrain", "rainticks": %i, "windticks": %i, "winddir": %.2f, "sent": %s}\r\n' % (
+            self.rainticks, self.windticks, self.random.randint(0, 7) * 45.0, sent)
+
+    def mangle(self, packet):
+        r = self.random
+        if r.random() < self.truncate:
+            self.faults["truncate"] += 1
+            cut = r.randint(1, len(packet) - 3)
+            packet = packet[:cut] + packet[cut + r.randint(1, len(packet) - 2 - cut):]
+        if r.random() < self.nulpad:
+            self.faults["nulpad"] += 1
+            at = r.randint(0, len(packet))
+            packet = packet[:at] + chr(0) * r.randint(1, 8) + packet[at:]
+        if r.random() < self.corrupt:
+            self.faults["corrupt"] += 1
+            at = r.randint(0, len(packet) - 3)
+            packet = packet[:at] + chr(r.randint(1, 255)) + packet[at + 1:]
+        return packet
+
+    def __run__(self):
+        interval = 1.0 / self.rate
+        due = time.time()
+        while self.running:
+            count = 1
+            if self.random.random() < self.burst:
+                self.faults["burst"] += 1
+                count = self.burstSize
+            packets = []
+            for i in range(count):
+                packets.append(self.mangle(self.packet()))
+                self.offered += 1
+            self.__write__(packets)
+            due += interval * count
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+    def __send__(self, data):
+        try:
+            return os.write(self.fd, data)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return 0
+
+    def __write__(self, packets):
+        if self.tail:
+            self.tail = self.tail[self.__send__(self.tail):]
+            if self.tail:
+                self.overflow += len(packets)
+                return
+        data = "".join(packets)
+        written = self.__send__(data)
+        for packet in packets:
+            if written <= 0:
+                self.overflow += 1
+                continue
+            if written < len(packet):
+                # the rest goes out first next time, so the stream stays intact
+                self.tail = packet[written:]
+            self.written += 1
+            written -= len(packet)
+
+
+class FakeTwitter(object):
+
+    """Stand-in for the Twython client behind EZTweet."""
+
+    def __init__(self):
+        super(FakeTwitter, self).__init__()
+        self.tweets = 0
+
+    def update_status(self, status):
+        self.tweets += 1
+
+
+class FakePWS(object):
+
+    """Stand-in for WundergroundPWS."""
+
+    def __init__(self):
+        super(FakePWS, self).__init__()
+        self.updates = 0
+
+    def update(self, **kwargs):
+        self.updates += 1
+
+
+class Soak(object):
+
+    """
+    Runs wx_bridge.bridge against a VirtualStation and collects statistics.
+    "bridge dropped" is written minus delivered, so it also includes whatever
+    is still in flight in the pty when the report is taken.
+    """
+
+    def __init__(self, station, ser, reportCfg, altitudeInMeters):
+        super(Soak, self).__init__()
+        self.station = station
+        self.ser = ser
+        self.reportCfg = reportCfg
+        self.wud = wx_bridge.WeatherUndergroundData(reportCfg["pws"], reportCfg["tweet"], altitudeInMeters)
+        self.twitter = FakeTwitter()
+        self.outbox = EZTweetOutbox(EZTweet(None, None, None, None, twitter=self.twitter), minBackoff=1)
+        self.pws = FakePWS()
+        self.delivered = 0
+        self.latencies = []
+        self.maxLatency = 0.0
+        self.deadline = None
+
+    def lines(self):
+        for line in wx_bridge.getChunk(self.ser):
+            if time.time() >= self.deadline:
+                return
+            if line:
+                yield line
+
+    def onObservation(self, data):
+        self.delivered += 1
+        try:
+            latency = time.time() - float(data["sent"])
+        except (KeyError, TypeError, ValueError):
+            return
+        if 0 <= latency < 3600:
+            self.latencies.append(latency)
+            self.maxLatency = max(self.maxLatency, latency)
+
+    def report(self, elapsed, startRSS, startMaxRSS):
+        # latencies are reset each report so multi-hour runs stay bounded
+        latencies, self.latencies = self.latencies, []
+        station = self.station
+        fmt = lambda x: "-" if x is None else "%.1fms" % (x * 1000)
+        print >> sys.__stdout__, (
+            "{0:8.0f}s offered {1} ({2:.1f}/s) overflow {3} | written {4} ({5:.1f}/s) "
+            "delivered {6} ({7:.1f}/s) bridge dropped {8} | latency p50 {9} p99 {10} max {11} | "
+            "rss {12:+d}KB (peak {13:+d}KB) | faults {14} | pws {15} tweets {16}").format(
+            elapsed, station.offered, station.offered / elapsed, station.overflow,
+            station.written, station.written / elapsed, self.delivered, self.delivered / elapsed,
+            station.written - self.delivered,
+            fmt(percentile(latencies, 50)), fmt(percentile(latencies, 99)), fmt(self.maxLatency),
+            currentRSSKb() - startRSS, maxRSSKb() - startMaxRSS,
+            station.faults, self.pws.updates, self.twitter.tweets)
+
+    def run(self, duration, reportInterval, verbose=False):
+        startRSS = currentRSSKb()
+        startMaxRSS = maxRSSKb()
+        start = time.time()
+        self.deadline = start + duration
+        done = threading.Event()
+
+        def reporter():
+            while not done.wait(reportInterval):
+                self.report(time.time() - start, startRSS, startMaxRSS)
+        thread = threading.Thread(target=reporter)
+        thread.daemon = True
+
+        self.station.start()
+        thread.start()
+        stdout, sys.stdout = sys.stdout, (sys.stdout if verbose else DEVNULL)
+        try:
+            wx_bridge.bridge(self.lines(), self.wud, self.outbox, self.pws, self.reportCfg, self.onObservation)
+        finally:
+            sys.stdout = stdout
+            done.set()
+            thread.join()
+            self.station.stop()
+        self.report(time.time() - start, startRSS, startMaxRSS)
+
+
+def openPty():
+    """
+    Returns (master fd, slave device path) for a raw pseudo-terminal pair.
+    The master is non-blocking so a stalled reader can't wedge the station.
+    """
+    (master, slave) = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    fcntl.fcntl(master, fcntl.F_SETFL, fcntl.fcntl(master, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return (master, os.ttyname(slave))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='wx_soak')
+    parser.add_argument('-t', '--doctest', help='Run doctests', required=False, action="store_true")
+    parser.add_argument('-r', '--rate', help='Packets per second', type=float, default=2.5)
+    parser.add_argument('-d', '--duration', help='Run time in seconds', type=float, default=60)
+    parser.add_argument('-i', '--interval', help='Seconds between reports', type=float, default=10)
+    parser.add_argument('--truncate', help='Probability a packet is truncated', type=float, default=0.0)
+    parser.add_argument('--nulpad', help='Probability a packet is NUL padded', type=float, default=0.0)
+    parser.add_argument('--corrupt', help='Probability a packet has a corrupted byte', type=float, default=0.0)
+    parser.add_argument('--burst', help='Probability of a burst of back-to-back packets', type=float, default=0.0)
+    parser.add_argument('--burst-size', help='Packets per burst', type=int, default=20)
+    parser.add_argument('--seed', help='Random seed', type=int, default=None)
+    parser.add_argument('-v', '--verbose', help='Show wx_bridge output', required=False, action="store_true")
+    args = parser.parse_args()
+
+    if args.doctest:
+        import doctest
+        doctest.testmod()
+        exit()
+
+    (master, slavePath) = openPty()
+    ser = serial.Serial(slavePath, 9600, timeout=0.5)
+    station = VirtualStation(master, args.rate, args.truncate, args.nulpad, args.corrupt,
+                             args.burst, args.burst_size, args.seed)
+    # publish as often as the bridge allows so publishing cost is part of the load
+    reportCfg = {"pws": 1, "tweet": 1, "console": 0, "prefill": 0}
+    print "wx_soak: {0} packets/sec for {1}s on {2}".format(args.rate, args.duration, slavePath)
+    Soak(station, ser, reportCfg, 269.933).run(args.duration, args.interval, args.verbose)